@@ -2,15 +2,52 @@ import sys
 import os
 import time
 import hashlib
+import ctypes
 import shutil
+import stat
 import logging
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-def permissions_check(path:str, must_write:bool, logger:logging.Logger) -> bool:
+# name of the optional file in the src root with gitignore-style include/exclude rules
+FILTER_FILE_NAME = '.syncignore'
+
+# size of the blocks read from both files at once when they are compared byte by byte
+COMPARE_CHUNK_SIZE = 1024 * 1024
+
+# digests of files/folders changed less than this many nanoseconds before they were read are not trusted
+# later, because another change within the same timestamp tick would not be visible in the stat data
+DIGEST_RACY_NS = 2_000_000_000
+
+# files of this size and bigger are split into ranges that are read, hashed and written by several threads
+PARALLEL_FILE_THRESHOLD = 256 * 1024 * 1024
+PARALLEL_RANGE_SIZE = 64 * 1024 * 1024
+PARALLEL_WORKERS = min(8, os.cpu_count() or 1)
+
+# how replica writes are made durable:
+# 'none' - never fsync, 'file' - fsync every written file and its folder right away,
+# 'dir' - fsync written files and their folder once the folder is synchronized,
+# 'syncfs' - one syncfs of the replica file system at the end of every synchronization that wrote something.
+# Changed files are copied to a temporary file that is flushed (with 'file' and 'dir') and renamed over
+# the old replica, so a crash leaves the old or the new content. Only the opt-in in place rewrite
+# of compare_and_copy can leave a partly written replica file
+DURABILITY_POLICIES = ('none', 'file', 'dir', 'syncfs')
+
+# suffix of the temporary files written by replace_file, a leftover one is deleted by the next synchronization
+REPLACE_SUFFIX = '.synctmp'
+
+# files smaller than this are copied by copy_difference with a single read and write through a reused buffer
+SMALL_FILE_THRESHOLD = 64 * 1024
+
+def permissions_check(path:str, must_write:bool, logger:logging.Logger, path_filter=None, rel_path:str = '') -> bool:
     """
     Recursively checks if all files/folders in the given path have needed permissions
     :param must_write True checks both read and write permissions, False checks read permissions only
     :param path str - given path to files/folders
     :param logger
+    :param path_filter - matcher from compile_filters, excluded files/folders are not checked
+    :param rel_path:str - path relative to the synchronized root, used by path_filter
     Returns False if any file/folder cannot be accessed as needed.
     """
     if not os.path.exists(path):
@@ -30,9 +67,9 @@ def permissions_check(path:str, must_write:bool, logger:logging.Logger) -> bool:
     # If it's a directory, check contents recursively
     if os.path.isdir(path):
         try:
-            for item in os.listdir(path):
+            for item in filtered_listdir(path, rel_path, path_filter):
                 item_path = os.path.join(path, item)
-                if not permissions_check(item_path, must_write, logger):
+                if not permissions_check(item_path, must_write, logger, path_filter, rel_join(rel_path, item)):
                     return False
         except PermissionError:
             logger.error(f"No permission to access directory: {path}")
@@ -103,8 +140,11 @@ def hashing(file_path:str) -> str:
     """
     Makes a hash  for a file at given path, reads up to 4096 bytes at a time
     :param file_path:str - a pth to the file which is goint to be given a hash
+    Files of PARALLEL_FILE_THRESHOLD and bigger get a tree hash from parallel_hashing instead
     :return: hash of a file at file_path
     """
+    if os.stat(file_path).st_size >= PARALLEL_FILE_THRESHOLD:
+        return parallel_hashing(file_path)
     hash_num = hashlib.md5()
     #in case of big file size read first 4096 bytes
     with open(file_path, "rb") as f:
@@ -113,100 +153,948 @@ def hashing(file_path:str) -> str:
         return hash_num.hexdigest()
 
 
+def _file_ranges(start:int, end:int) -> list:
+    """
+    Splits the bytes from start to end of a file into PARALLEL_RANGE_SIZE ranges
+    :return: list of (range_start, range_end)
+    """
+    return [(offset, min(offset + PARALLEL_RANGE_SIZE, end)) for offset in range(start, end, PARALLEL_RANGE_SIZE)]
+
+
+def _pwrite_all(fd:int, data, offset:int) -> None:
+    """
+    Writes all data at the offset, os.pwrite may write only a part of it
+    """
+    data = memoryview(data)
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+
+def _copy_range(src_fd:int, dst_fd:int, start:int, end:int) -> None:
+    """
+    Copies the bytes from start to end of src_fd to the same place in dst_fd
+    """
+    offset = start
+    while offset < end:
+        chunk = os.pread(src_fd, min(COMPARE_CHUNK_SIZE, end - offset), offset)
+        if not chunk:
+            break
+        _pwrite_all(dst_fd, chunk, offset)
+        offset += len(chunk)
+
+
+def _hash_range(fd:int, start:int, end:int) -> bytes:
+    """
+    Makes a hash of the bytes from start to end of the file
+    """
+    hash_num = hashlib.md5()
+    offset = start
+    while offset < end:
+        chunk = os.pread(fd, min(COMPARE_CHUNK_SIZE, end - offset), offset)
+        if not chunk:
+            break
+        hash_num.update(chunk)
+        offset += len(chunk)
+    return hash_num.digest()
+
+
+def parallel_hashing(file_path:str) -> str:
+    """
+    Makes a tree hash for a big file: PARALLEL_RANGE_SIZE ranges are hashed by PARALLEL_WORKERS threads
+    and the hash of the file is a hash over the range hashes. The result is not the md5 of the file,
+    but it is the same for files with the same content, so it can be compared like hashing() results.
+    :param file_path:str - a path to the file
+    :return: tree hash of a file at file_path
+    """
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        with ThreadPoolExecutor(PARALLEL_WORKERS) as pool:
+            range_hashes = pool.map(lambda file_range: _hash_range(fd, *file_range), _file_ranges(0, size))
+            hash_num = hashlib.md5()
+            for range_hash in range_hashes:
+                hash_num.update(range_hash)
+        return hash_num.hexdigest()
+    finally:
+        os.close(fd)
+
+
+def parallel_copy_range(src_fd:int, dst_fd:int, start:int, size:int) -> None:
+    """
+    Copies the bytes from start to the end of src_fd to dst_fd, PARALLEL_RANGE_SIZE ranges are
+    copied with os.pread/os.pwrite by PARALLEL_WORKERS threads. dst_fd is preallocated with
+    posix_fallocate (if the platform and the file system support it) and cut to size.
+    :param src_fd:int - file descriptor of the file in src
+    :param dst_fd:int - file descriptor of the file in replica, opened for writing
+    :param start:int - offset of the first byte to copy
+    :param size:int - size of the file in src
+    """
+    if hasattr(os, 'posix_fallocate') and size > start:
+        try:
+            os.posix_fallocate(dst_fd, start, size - start)
+        except OSError:
+            pass
+    os.ftruncate(dst_fd, size)
+    with ThreadPoolExecutor(PARALLEL_WORKERS) as pool:
+        # list() re-raises an error from any of the workers
+        list(pool.map(lambda file_range: _copy_range(src_fd, dst_fd, *file_range), _file_ranges(start, size)))
+
+
+def copy_file(src_file_path:str, dst_file_path:str) -> None:
+    """
+    Copies the file with its permissions, like shutil.copy, files of PARALLEL_FILE_THRESHOLD
+    and bigger are copied with parallel_copy_range
+    :param src_file_path:str - path to the file in src
+    :param dst_file_path:str - path to the new file in replica
+    """
+    src_stat = os.stat(src_file_path)
+    # opening a named pipe would block, so files that are not regular are left to shutil.copy,
+    # which refuses to copy named pipes
+    if not stat.S_ISREG(src_stat.st_mode) or src_stat.st_size < PARALLEL_FILE_THRESHOLD:
+        shutil.copy(src_file_path, dst_file_path)
+        return
+    src_fd = os.open(src_file_path, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(dst_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            parallel_copy_range(src_fd, dst_fd, 0, size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copymode(src_file_path, dst_file_path)
+
+
+def _new_file_hash(size:int) -> dict:
+    """
+    Creates the state for _file_hash_update, it gives the same hash as hashing()
+    for a file of this size that is read from its start
+    """
+    return {'tree': size >= PARALLEL_FILE_THRESHOLD, 'range': hashlib.md5(), 'range_left': PARALLEL_RANGE_SIZE,
+            'ranges': hashlib.md5()}
+
+
+def _file_hash_update(file_hash:dict, data) -> None:
+    """
+    Adds the next bytes of the file to the hash, for a tree hash the range hashes are finished
+    at the same PARALLEL_RANGE_SIZE borders as in parallel_hashing
+    """
+    if not file_hash['tree']:
+        file_hash['range'].update(data)
+        return
+    data = memoryview(data)
+    while data:
+        part = data[:file_hash['range_left']]
+        file_hash['range'].update(part)
+        file_hash['range_left'] -= len(part)
+        data = data[len(part):]
+        if file_hash['range_left'] == 0:
+            file_hash['ranges'].update(file_hash['range'].digest())
+            file_hash['range'] = hashlib.md5()
+            file_hash['range_left'] = PARALLEL_RANGE_SIZE
+
+
+def _file_hash_hexdigest(file_hash:dict) -> str:
+    """
+    Finishes the hash from _new_file_hash
+    """
+    if not file_hash['tree']:
+        return file_hash['range'].hexdigest()
+    if file_hash['range_left'] != PARALLEL_RANGE_SIZE:
+        file_hash['ranges'].update(file_hash['range'].digest())
+    return file_hash['ranges'].hexdigest()
+
+
+def replace_file(src_file_path:str, dst_file_path:str, durability:dict = None) -> None:
+    """
+    Replaces the replica file with a copy of src without ever leaving a partly written replica:
+    src is copied to a temporary file in the replica folder, the temporary file is flushed according
+    to the durability policy and renamed over the old file with os.replace. The new file also breaks
+    hard links to the old one and works for read-only replicas.
+    :param src_file_path:str - path to the file in src
+    :param dst_file_path:str - path to the file in replica
+    :param durability:dict - state from new_durability or None
+    """
+    dir_path, name = os.path.split(dst_file_path)
+    # the name is shortened, so the temporary name still fits into the file name length limit
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix=f'.{name[:100]}.', suffix=REPLACE_SUFFIX, dir=dir_path or '.')
+    try:
+        try:
+            src_fd = os.open(src_file_path, os.O_RDONLY)
+            try:
+                src_stat = os.fstat(src_fd)
+                if src_stat.st_size >= PARALLEL_FILE_THRESHOLD:
+                    parallel_copy_range(src_fd, tmp_fd, 0, src_stat.st_size)
+                else:
+                    _copy_range(src_fd, tmp_fd, 0, src_stat.st_size)
+                os.fchmod(tmp_fd, stat.S_IMODE(src_stat.st_mode))
+            finally:
+                os.close(src_fd)
+            durability_file_ready(durability, tmp_fd)
+        finally:
+            os.close(tmp_fd)
+        os.replace(tmp_path, dst_file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    durability_entry_changed(durability, dir_path)
+
+
+def compare_and_copy(src_file_path:str, dst_file_path:str, chunk_size:int = COMPARE_CHUNK_SIZE,
+                     digest_cache:dict = None, durability:dict = None, in_place:bool = False) -> bool:
+    """
+    Compares the files directly instead of hashing both of them fully.
+    Sizes are checked first, then both files are read together in chunk_size blocks
+    and the comparison stops at the first mismatching block. A different replica is replaced
+    with replace_file, so a crash never leaves it partly written. With in_place the replica
+    is rewritten starting from the mismatching block instead, using the already read src bytes,
+    because everything before it is already identical. This is faster for big files, but a crash
+    during the rewrite can leave a partly written replica. Read-only replicas and replicas
+    with hard links are always replaced.
+    :param src_file_path:str - path to the file in src
+    :param dst_file_path:str - path to the file in replica
+    :param chunk_size:int - size of the blocks read at once
+    :param digest_cache:dict - cache from new_digest_cache or None, if the files are the same,
+                               the hash of the src bytes read during the comparison is stored for both
+    :param durability:dict - state from new_durability or None
+    :param in_place:bool - rewrite different replicas in place instead of replacing them
+    :return: True if the replica file was rewritten, False if the files were the same
+    """
+    src_stat = os.stat(src_file_path)
+    dst_stat = os.stat(dst_file_path)
+    if src_stat.st_size != dst_stat.st_size:
+        replace_file(src_file_path, dst_file_path, durability)
+        return True
+
+    # writing in place would fail for a read-only replica and would change every hard link to it
+    in_place = in_place and dst_stat.st_nlink == 1 and os.access(dst_file_path, os.W_OK)
+    # small files do not need the whole chunk_size, zero-filling big buffers would cost more than reading them
+    buffer_size = min(chunk_size, src_stat.st_size)
+    src_buffer = bytearray(buffer_size)
+    dst_buffer = bytearray(buffer_size)
+    file_hash = _new_file_hash(src_stat.st_size) if digest_cache is not None else None
+    with open(src_file_path, "rb", buffering=0) as src_file, \
+            open(dst_file_path, "r+b" if in_place else "rb", buffering=0) as dst_file:
+        offset = 0
+        while True:
+            src_read = src_file.readinto(src_buffer)
+            if not src_read:
+                if file_hash is not None:
+                    digest = _file_hash_hexdigest(file_hash)
+                    record_file_digest(src_file_path, src_stat, digest, digest_cache)
+                    record_file_digest(dst_file_path, dst_stat, digest, digest_cache)
+                return False
+            dst_read = dst_file.readinto(memoryview(dst_buffer)[:src_read])
+            if dst_read != src_read or src_buffer[:src_read] != dst_buffer[:src_read]:
+                break
+            if file_hash is not None:
+                _file_hash_update(file_hash, memoryview(src_buffer)[:src_read])
+            offset += src_read
+
+        if not in_place:
+            dst_file.close()
+            replace_file(src_file_path, dst_file_path, durability)
+            return True
+
+        #first mismatching block found, rewriting the replica from it
+        src_fd, dst_fd = src_file.fileno(), dst_file.fileno()
+        _pwrite_all(dst_fd, memoryview(src_buffer)[:src_read], offset)
+        offset += src_read
+        size = os.fstat(src_fd).st_size
+        if size - offset >= PARALLEL_FILE_THRESHOLD:
+            parallel_copy_range(src_fd, dst_fd, offset, size)
+        else:
+            _copy_range(src_fd, dst_fd, offset, size)
+            os.ftruncate(dst_fd, size)
+    shutil.copymode(src_file_path, dst_file_path)
+    durability_file_written(durability, *os.path.split(dst_file_path))
+    return True
+
+
+def new_durability(policy:str) -> dict:
+    """
+    Creates the durability state for one of DURABILITY_POLICIES.
+    'files' holds written files waiting for fsync by their folder, 'dirs' holds folders whose
+    entries were created, removed or renamed, 'dirty' is set when the synchronization wrote anything,
+    'fsync_count' and 'sync_seconds' measure the policy cost
+    :param policy:str - one of DURABILITY_POLICIES
+    :return: dict
+    """
+    return {'policy': policy, 'files': {}, 'dirs': set(), 'dirty': False, 'fsync_count': 0, 'sync_seconds': 0.0}
+
+
+def _fsync_fd(durability:dict, fd:int) -> None:
+    """
+    Flushes an open file or folder to the disk and counts the time spent on it
+    """
+    start = time.perf_counter()
+    os.fsync(fd)
+    durability['fsync_count'] += 1
+    durability['sync_seconds'] += time.perf_counter() - start
+
+
+def _fsync_path(durability:dict, path:str) -> None:
+    """
+    Flushes a file or a folder to the disk and counts the time spent on it
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        _fsync_fd(durability, fd)
+    finally:
+        os.close(fd)
+
+
+def durability_file_ready(durability:dict, fd:int) -> None:
+    """
+    Registers a temporary file that is going to be renamed over a replica file,
+    with the 'file' and 'dir' policies it is flushed right away, because the rename
+    must not reach the disk before the content
+    :param durability:dict - state from new_durability or None
+    :param fd:int - descriptor of the temporary file
+    """
+    if durability is None:
+        return
+    durability['dirty'] = True
+    if durability['policy'] in ('file', 'dir'):
+        _fsync_fd(durability, fd)
+
+
+def durability_file_written(durability:dict, dir_path:str, name:str) -> None:
+    """
+    Registers a file whose content was written in replica,
+    the path is joined only if the policy needs it
+    :param durability:dict - state from new_durability or None
+    :param dir_path:str - path to the folder of the written file
+    :param name:str - name of the written file
+    """
+    if durability is None:
+        return
+    durability['dirty'] = True
+    if durability['policy'] == 'file':
+        _fsync_path(durability, os.path.join(dir_path, name))
+    elif durability['policy'] == 'dir':
+        durability['files'].setdefault(os.path.normpath(dir_path), set()).add(os.path.join(dir_path, name))
+
+
+def durability_entry_changed(durability:dict, dir_path:str) -> None:
+    """
+    Registers a folder in replica where a file/folder was created, removed or renamed,
+    the folder itself has to be flushed for the change to survive a crash
+    :param durability:dict - state from new_durability or None
+    :param dir_path:str - path to the parent folder of the changed entry
+    """
+    if durability is None:
+        return
+    durability['dirty'] = True
+    if durability['policy'] == 'file':
+        _fsync_path(durability, dir_path)
+    elif durability['policy'] == 'dir':
+        durability['dirs'].add(os.path.normpath(dir_path))
+
+
+def durability_flush_dir(durability:dict, dir_path:str) -> None:
+    """
+    With the 'dir' policy flushes the files written in the folder and then the folder itself,
+    it is called once the folder is synchronized
+    :param durability:dict - state from new_durability or None
+    :param dir_path:str - path to the folder in replica
+    """
+    if durability is None or durability['policy'] != 'dir':
+        return
+    dir_path = os.path.normpath(dir_path)
+    for file_path in durability['files'].pop(dir_path, ()):
+        _fsync_path(durability, file_path)
+    if dir_path in durability['dirs']:
+        durability['dirs'].discard(dir_path)
+        _fsync_path(durability, dir_path)
+
+
+def _syncfs(path:str) -> None:
+    """
+    Flushes the whole file system that contains path, falls back to os.sync where syncfs is not available
+    """
+    try:
+        libc_syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if libc_syncfs(fd) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+    finally:
+        os.close(fd)
+
+
+def durability_finish_pass(durability:dict, replica_path:str, logger: logging.Logger) -> None:
+    """
+    Makes the rest of the synchronization durable according to the policy and logs the cost of the policy,
+    nothing is synced or logged if the synchronization did not write anything
+    :param durability:dict - state from new_durability or None
+    :param replica_path:str - path to replica folder
+    :param  logger: logging.Logger - logger
+    """
+    if durability is None:
+        return
+    if durability['policy'] == 'dir':
+        for dir_path in list(durability['files']) + list(durability['dirs']):
+            durability_flush_dir(durability, dir_path)
+    elif durability['policy'] == 'syncfs' and durability['dirty']:
+        start = time.perf_counter()
+        _syncfs(replica_path)
+        durability['fsync_count'] += 1
+        durability['sync_seconds'] += time.perf_counter() - start
+    if durability['dirty'] or durability['fsync_count']:
+        logger.info(f"Durability policy '{durability['policy']}': {durability['fsync_count']} sync calls, "
+                    f"{durability['sync_seconds']:.3f} s")
+    durability['dirty'] = False
+    durability['fsync_count'] = 0
+    durability['sync_seconds'] = 0.0
+
+
+def new_digest_cache() -> dict:
+    """
+    Creates the cache used by file_digest and dir_digest, it is kept between synchronizations.
+    'nodes' holds digests together with the stat data they were computed for,
+    'pass' holds digests already computed during the current synchronization.
+    Like in git, the stat data includes ctime, so a change that restores the mtime is still noticed
+    :return: dict
+    """
+    return {'nodes': {}, 'pass': {}}
+
+
+def _file_signature(file_stat:os.stat_result) -> tuple:
+    """
+    Stat data that has to stay the same for a cached file digest to be used
+    """
+    return file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ctime_ns, file_stat.st_ino
+
+
+def record_file_digest(file_path:str, file_stat:os.stat_result, digest:str, digest_cache:dict) -> None:
+    """
+    Stores the content hash of a file for the stat data it was computed for
+    :param file_path:str - path to the file
+    :param file_stat:os.stat_result - stat of the file taken before its content was read
+    :param digest:str - hash of the file, the same as hashing() gives
+    :param digest_cache:dict - cache from new_digest_cache
+    """
+    if time.time_ns() - file_stat.st_ctime_ns > DIGEST_RACY_NS:
+        digest_cache['nodes'][file_path] = (_file_signature(file_stat), digest)
+    digest_cache['pass'][file_path] = digest
+
+
+def cached_file_digest(file_path:str, digest_cache:dict):
+    """
+    Returns the cached content hash of a file without reading it
+    :param file_path:str - path to the file
+    :param digest_cache:dict - cache from new_digest_cache
+    :return: hash of a file at file_path, or None if its size, mtime, ctime or inode changed since it was hashed
+    """
+    pass_digests = digest_cache['pass']
+    if file_path in pass_digests:
+        return pass_digests[file_path]
+
+    cached = digest_cache['nodes'].get(file_path)
+    digest = None
+    if cached is not None and cached[0] == _file_signature(os.stat(file_path)):
+        digest = cached[1]
+    pass_digests[file_path] = digest
+    return digest
+
+
+def file_digest(file_path:str, digest_cache:dict) -> str:
+    """
+    Returns the content hash of a file, the file is hashed again only if its size, mtime, ctime or inode changed
+    :param file_path:str - path to the file
+    :param digest_cache:dict - cache from new_digest_cache
+    :return: hash of a file at file_path
+    """
+    digest = cached_file_digest(file_path, digest_cache)
+    if digest is None:
+        file_stat = os.stat(file_path)
+        digest = hashing(file_path)
+        record_file_digest(file_path, file_stat, digest, digest_cache)
+    return digest
+
+
+def _drop_digest_node(nodes:dict, path:str) -> None:
+    """
+    Removes the cached digest of a deleted file/folder, for a folder also of everything inside it
+    """
+    cached = nodes.pop(path, None)
+    # folder nodes are (signature, entries, children, digest), file nodes are (signature, digest)
+    if cached is not None and len(cached) == 4:
+        for name, _ in cached[1]:
+            _drop_digest_node(nodes, os.path.join(path, name))
+
+
+def dir_digest(path:str, digest_cache:dict, path_filter=None, rel_path:str = '') -> str:
+    """
+    Returns a Merkle digest of the folder: a hash over names, types and digests of all its children,
+    so two folders have the same digest only if their whole subtrees are the same.
+    Files are never read here, a file without a valid cached digest makes the folder dirty.
+    The folder is listed again only if its mtime or ctime changed (something was added, removed
+    or renamed), files are hashed again only if their stat changed, and the digest itself is rebuilt
+    only if some child digest changed. Cached digests of children that are gone are dropped.
+    :param path:str - path to the folder
+    :param digest_cache:dict - cache from new_digest_cache
+    :param path_filter - matcher from compile_filters or None, excluded children are not part of the digest
+    :param rel_path:str - path of the folder relative to the synchronized root
+    :return: digest of the folder at path, or None if something in it changed since it was compared
+    """
+    pass_digests = digest_cache['pass']
+    if path in pass_digests:
+        return pass_digests[path]
+
+    nodes = digest_cache['nodes']
+    dir_stat = os.stat(path)
+    signature = (dir_stat.st_mtime_ns, dir_stat.st_ctime_ns)
+    cached = nodes.get(path)
+    if cached is not None and cached[0] == signature:
+        entries = cached[1]
+    else:
+        with os.scandir(path) as dir_entries:
+            entries = tuple(sorted(
+                (entry.name, entry.is_dir()) for entry in dir_entries
+                if path_filter is None or not path_filter(rel_join(rel_path, entry.name), entry.is_dir())))
+        if cached is not None:
+            for name, is_dir in set(cached[1]) - set(entries):
+                _drop_digest_node(nodes, os.path.join(path, name))
+
+    children = tuple(
+        dir_digest(os.path.join(path, name), digest_cache, path_filter, rel_join(rel_path, name)) if is_dir
+        else cached_file_digest(os.path.join(path, name), digest_cache)
+        for name, is_dir in entries)
+
+    if None in children:
+        digest = None
+    elif cached is not None and cached[1] == entries and cached[2] == children:
+        digest = cached[3]
+    else:
+        hash_num = hashlib.md5()
+        for (name, is_dir), child_digest in zip(entries, children):
+            node = f"{'d' if is_dir else 'f'}\0{name}\0{child_digest}\n"
+            hash_num.update(node.encode('utf-8', 'surrogateescape'))
+        digest = hash_num.hexdigest()
+
+    # a folder changed too recently keeps its node for pruning, but its listing is not reused
+    if time.time_ns() - dir_stat.st_ctime_ns <= DIGEST_RACY_NS:
+        signature = None
+    nodes[path] = (signature, entries, children, digest)
+    pass_digests[path] = digest
+    return digest
+
+
+def _filter_char_class(pattern:str, start:int):
+    """
+    Translates the character class that starts after the '[' at start, like fnmatch.translate:
+    a leading ']' is a literal, '!' negates the class and invalid ranges like 'z-a' are dropped.
+    Unlike fnmatch, the class never matches '/'
+    :param pattern:str - glob
+    :param start:int - index after the '['
+    :return: (regular expression, index of the closing ']'), or (None, start) if the class is not closed
+    """
+    end = start
+    if end < len(pattern) and pattern[end] == '!':
+        end += 1
+    if end < len(pattern) and pattern[end] == ']':
+        end += 1
+    end = pattern.find(']', end)
+    if end == -1:
+        return None, start
+
+    negate = pattern[start] == '!'
+    items = []
+    i = start + 1 if negate else start
+    while i < end:
+        if i + 2 < end and pattern[i + 1] == '-':
+            low, high = pattern[i], pattern[i + 2]
+            if low <= high:
+                items.append(f'{re.escape(low)}-{re.escape(high)}')
+            i += 3
+        else:
+            items.append(re.escape(pattern[i]))
+            i += 1
+
+    if negate:
+        return f"[^/{''.join(items)}]", end
+    if not items:
+        # only invalid ranges, nothing can match
+        return '(?!)', end
+    return f"(?!/)[{''.join(items)}]", end
+
+
+def _filter_pattern_to_regex(pattern:str) -> str:
+    """
+    Translates a single gitignore-style glob into a regular expression body
+    :param pattern:str - glob without the leading '!' and the trailing '/'
+    :return: regular expression matching a '/'-separated relative path
+    """
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        # '**' is special only as a whole path segment, elsewhere it works like '*'
+        if pattern.startswith('**', i) and (i == 0 or pattern[i - 1] == '/'):
+            if pattern.startswith('**/', i):
+                # '**/' matches zero or more folders
+                regex += '(?:.*/)?'
+                i += 3
+                continue
+            if i + 2 == len(pattern):
+                regex += '.*'
+                i += 2
+                continue
+        if char == '*':
+            regex += '[^/]*'
+            while i + 1 < len(pattern) and pattern[i + 1] == '*':
+                i += 1
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[':
+            char_class, end = _filter_char_class(pattern, i + 1)
+            if char_class is None:
+                regex += re.escape(char)
+            else:
+                regex += char_class
+                i = end
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(char)
+        i += 1
+    return regex
+
+
+def compile_filters(patterns:list, logger: logging.Logger = None):
+    """
+    Compiles gitignore-style include/exclude rules once into a matcher.
+    Rules are applied in order and the last matching rule wins, '!rule' re-includes a path,
+    'rule/' matches only folders, a rule containing '/' is anchored to the synchronized root,
+    otherwise it matches the name at any depth. Like in git, files inside an excluded folder
+    cannot be re-included, because the folder is never walked.
+
+    :param patterns:list - rule lines, empty lines and lines starting with '#' are skipped
+    :param  logger: logging.Logger - logger for invalid rules, they are skipped
+    :return: function(rel_path:str, is_dir:bool) -> bool that returns True if the path is excluded,
+             or None if there are no rules
+    """
+    rules = []
+    for line in patterns:
+        line = line.rstrip('\n').rstrip()
+        if not line or line.startswith('#'):
+            continue
+        rule = line
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        elif line.startswith('\\!') or line.startswith('\\#'):
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            continue
+        if '/' in line:
+            regex = _filter_pattern_to_regex(line.lstrip('/'))
+        else:
+            regex = '(?:.*/)?' + _filter_pattern_to_regex(line)
+        try:
+            re.compile(regex)
+        except re.error as error:
+            if logger is not None:
+                logger.error(f"Invalid filter rule {rule}: {error}")
+            continue
+        rules.append((regex, negate, dir_only))
+
+    if not rules:
+        return None
+
+    if not any(negate for _, negate, _ in rules):
+        # without re-include rules any match excludes, so all rules are merged into one regex
+        dir_regex = re.compile('|'.join(f'(?:{regex})' for regex, _, _ in rules))
+        file_rules = [f'(?:{regex})' for regex, _, dir_only in rules if not dir_only]
+        file_regex = re.compile('|'.join(file_rules)) if file_rules else None
+
+        def is_excluded(rel_path:str, is_dir:bool) -> bool:
+            if is_dir:
+                return dir_regex.fullmatch(rel_path) is not None
+            return file_regex is not None and file_regex.fullmatch(rel_path) is not None
+
+        return is_excluded
+
+    compiled_rules = [(re.compile(regex), negate, dir_only) for regex, negate, dir_only in reversed(rules)]
+
+    def is_excluded(rel_path:str, is_dir:bool) -> bool:
+        for regex, negate, dir_only in compiled_rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.fullmatch(rel_path):
+                return not negate
+        return False
+
+    return is_excluded
+
+
+def load_filter_file(src_path:str) -> list:
+    """
+    Reads include/exclude rules from FILTER_FILE_NAME in the src root
+    :param src_path:str - path to src folder
+    :return: list of rule lines, empty if there is no filter file
+    """
+    filter_path = os.path.join(src_path, FILTER_FILE_NAME)
+    if not os.path.isfile(filter_path):
+        return []
+    with open(filter_path, encoding='utf-8') as f:
+        return f.readlines()
+
+
+def rel_join(rel_path:str, name:str) -> str:
+    """
+    Joins a name to a path relative to the synchronized root, the root itself is ''
+    """
+    return f'{rel_path}/{name}' if rel_path else name
+
+
+def filtered_listdir(path:str, rel_path:str, path_filter) -> list:
+    """
+    Lists the folder content without the excluded files/folders,
+    so the excluded subtrees are never walked or hashed
+    :param path:str - path to the folder
+    :param rel_path:str - path of the folder relative to the synchronized root
+    :param path_filter - matcher from compile_filters or None
+    :return: list of names
+    """
+    if path_filter is None:
+        return os.listdir(path)
+    with os.scandir(path) as entries:
+        return [entry.name for entry in entries
+                if not path_filter(rel_join(rel_path, entry.name), entry.is_dir())]
+
+
+def _scan_dir_fd(dir_fd:int, rel_path:str, path_filter) -> dict:
+    """
+    Lists the folder opened as dir_fd without the excluded files/folders
+    :param dir_fd:int - descriptor of the open folder
+    :param rel_path:str - path of the folder relative to the synchronized root
+    :param path_filter - matcher from compile_filters or None
+    :return: dict of name -> os.DirEntry
+    """
+    with os.scandir(dir_fd) as entries:
+        return {entry.name: entry for entry in entries
+                if path_filter is None or not path_filter(rel_join(rel_path, entry.name), entry.is_dir())}
+
+
+def _write_all(fd:int, data) -> None:
+    """
+    Writes all data, os.write may write only a part of it
+    """
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data):]
+
 
+def _copy_small_file(src_dir_fd:int, replica_dir_fd:int, name:str, mode:int, buffer:bytearray) -> None:
+    """
+    Copies a small file between two open folders with a single read and write through the reused buffer,
+    the new file gets the permissions of the src file like with shutil.copy
+    :param src_dir_fd:int - descriptor of the src folder
+    :param replica_dir_fd:int - descriptor of the replica folder
+    :param name:str - name of the file
+    :param mode:int - permission bits of the src file
+    :param buffer:bytearray - buffer of SMALL_FILE_THRESHOLD bytes reused for all files
+    """
+    src_fd = os.open(name, os.O_RDONLY, dir_fd=src_dir_fd)
+    try:
+        dst_fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode, dir_fd=replica_dir_fd)
+        try:
+            #a full buffer means that the file has grown since it was checked, so reading goes on
+            while True:
+                read = os.readv(src_fd, [buffer])
+                if read:
+                    _write_all(dst_fd, memoryview(buffer)[:read])
+                if read < len(buffer):
+                    break
+            #the mode given to os.open is limited by umask and not used for an existing file
+            os.fchmod(dst_fd, mode)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
 
-def copy_difference(src_path:str, replica_path:str, logger: logging.Logger) -> None:
+
+def copy_difference(src_path:str, replica_path:str, logger: logging.Logger, path_filter=None, rel_path:str = '',
+                    durability:dict = None) -> None:
     """
     Function copies files from src if they are absent in dst,
     and to delete content that exists only in dst.
+    Excluded files/folders are skipped on both sides, so they are left alone in the replica.
+    Every folder is opened once and its content is accessed relative to the folder descriptor,
+    files smaller than SMALL_FILE_THRESHOLD are copied with a single read and write.
 
     :param src_path:str - path to src folder
     :param replica_path:str - path to replica or dst folder
     :param  logger: logging.Logger - logger
+    :param path_filter - matcher from compile_filters or None
+    :param rel_path:str - path of src_path relative to the synchronized root
+    :param durability:dict - state from new_durability or None
     :return: None
     """
+    src_dir_fd = os.open(src_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        replica_dir_fd = os.open(replica_path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            _copy_difference_fd(src_dir_fd, replica_dir_fd, src_path, replica_path, logger, path_filter, rel_path,
+                                durability, bytearray(SMALL_FILE_THRESHOLD))
+        finally:
+            os.close(replica_dir_fd)
+    finally:
+        os.close(src_dir_fd)
+
+
+def _copy_difference_fd(src_dir_fd:int, replica_dir_fd:int, src_path:str, replica_path:str, logger: logging.Logger,
+                        path_filter, rel_path:str, durability:dict, buffer:bytearray) -> None:
+    """
+    copy_difference for folders that are already open, paths are used only for logging
+    and for the rare operations that need them (deleting folders, copying big files)
+    :param src_dir_fd:int - descriptor of the src folder
+    :param replica_dir_fd:int - descriptor of the replica folder
+    :param buffer:bytearray - buffer for _copy_small_file
+    other params are the same as in copy_difference
+    """
 
     # Creating a lists of content in both folders
-    src_content = os.listdir(src_path)
-    replica_content = os.listdir(replica_path)
+    src_content = _scan_dir_fd(src_dir_fd, rel_path, path_filter)
+    replica_content = _scan_dir_fd(replica_dir_fd, rel_path, path_filter)
 
     # checking the difference in folders content via operations with sets
-    if set(src_content) != set(replica_content):
+    if src_content.keys() != replica_content.keys():
 
         # a set of files/folders that exist only in src, and need to be added to dst
-        diff_src = set(src_content) - set(replica_content)
-
-        # a set of files that are unique for both folders
-        dif_src_and_dst = set(src_content) ^ set(replica_content)
+        diff_src = src_content.keys() - replica_content.keys()
 
         # a set of name of the files that exist only in dst folder, and need to be deleted
-        to_delete = dif_src_and_dst - diff_src
+        to_delete = replica_content.keys() - src_content.keys()
 
         # deleting files from dst
-        if len(to_delete) != 0:
-            for name in to_delete:
-                delete_replica_path = os.path.join(replica_path, name)
-                # checking if we need to remove folder or file
-                if os.path.isdir(delete_replica_path):
-                    shutil.rmtree(delete_replica_path)
-                    logger.info(f"Deleted a folder {name} from {replica_path}")
+        for name in to_delete:
+            # checking if we need to remove folder or file
+            if replica_content[name].is_dir():
+                shutil.rmtree(os.path.join(replica_path, name))
+                logger.info(f"Deleted a folder {name} from {replica_path}")
+            else:
+                os.unlink(name, dir_fd=replica_dir_fd)
+                logger.info(f"Deleted file {name} from {replica_path}")
+            durability_entry_changed(durability, replica_path)
+
+        # copying src's unique files and creating src's unique folders in dst
+        sub_folders = []
+        for name in diff_src:
+            src_entry = src_content[name]
+            if not src_entry.is_dir():
+                file_stat = src_entry.stat()
+                if stat.S_ISREG(file_stat.st_mode) and file_stat.st_size < SMALL_FILE_THRESHOLD:
+                    _copy_small_file(src_dir_fd, replica_dir_fd, name, stat.S_IMODE(file_stat.st_mode), buffer)
                 else:
-                    os.remove(delete_replica_path)
-                    logger.info(f"Deleted file {name} from {replica_path}")
-
-        # copying src's unique files and folders to dst
-        if len(diff_src) != 0:
-            for name in diff_src:
-                new_src_path = os.path.join(src_path,name)
-                if not os.path.isdir(new_src_path):
-                    shutil.copy(new_src_path, replica_path)
-                    logger.info(f'Copied the file {name} from {src_path} to {replica_path} ')
-                elif os.path.isdir(new_src_path):
-                    new_replica_path = os.path.join(replica_path,name)
-                    os.mkdir(new_replica_path)
-                    logger.info(f'Copied a folder {name} from {src_path} to {replica_path}')
-                    #Recursive folder_synchronization
-                    copy_difference(new_src_path, new_replica_path, logger)
+                    copy_file(os.path.join(src_path, name), os.path.join(replica_path, name))
+                durability_file_written(durability, replica_path, name)
+                durability_entry_changed(durability, replica_path)
+                logger.info(f'Copied the file {name} from {src_path} to {replica_path} ')
+            else:
+                os.mkdir(name, dir_fd=replica_dir_fd)
+                durability_entry_changed(durability, replica_path)
+                logger.info(f'Copied a folder {name} from {src_path} to {replica_path}')
+                sub_folders.append(name)
     else:
-        for folder_name in src_content:
-            new_src_path = os.path.join(src_path, folder_name)
-            new_replica_path = os.path.join(replica_path, folder_name)
-            if os.path.isdir(new_src_path) :
-                copy_difference(new_src_path, new_replica_path, logger)
+        sub_folders = [name for name, src_entry in src_content.items() if src_entry.is_dir()]
 
+    #Recursive folder_synchronization
+    for name in sub_folders:
+        sub_src_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=src_dir_fd)
+        try:
+            sub_replica_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=replica_dir_fd)
+            try:
+                _copy_difference_fd(sub_src_fd, sub_replica_fd, os.path.join(src_path, name),
+                                    os.path.join(replica_path, name), logger, path_filter, rel_join(rel_path, name),
+                                    durability, buffer)
+            finally:
+                os.close(sub_replica_fd)
+        finally:
+            os.close(sub_src_fd)
 
+    durability_flush_dir(durability, replica_path)
 
-def hash_check(src_path:str, dst_path:str, logger: logging.Logger) -> None:
+
+
+def hash_check(src_path:str, dst_path:str, logger: logging.Logger, path_filter=None, rel_path:str = '',
+               compare_mode:str = 'bytes', digest_cache:dict = None, durability:dict = None,
+               in_place:bool = False) -> None:
     """
     Function goes through all files and compares their hash in src and in replica, if not the same,
     delete the file/folder from replica and copy it from src
     :param src_path:srt - path to src folder
     :param dst_path:str - path to replica or dst folder
     :param  logger: logging.Logger - logger
+    :param path_filter - matcher from compile_filters or None
+    :param rel_path:str - path of src_path relative to the synchronized root
+    :param compare_mode:str - 'bytes' compares the files directly with compare_and_copy,
+                              'hash' compares full hashes of both files
+    :param digest_cache:dict - cache from new_digest_cache, if given, subtrees with the same
+                               dir_digest in src and replica are skipped without being walked
+                               and files with unchanged stat are skipped by their cached digests
+    :param durability:dict - state from new_durability or None
+    :param in_place:bool - with compare_mode 'bytes', rewrite different files in place, see compare_and_copy
     :return: None
     """
+    if digest_cache is not None:
+        # both digests are built even if src is dirty, so the replica nodes exist for pruning later
+        src_digest = dir_digest(src_path, digest_cache, path_filter, rel_path)
+        dst_digest = dir_digest(dst_path, digest_cache, path_filter, rel_path)
+        if src_digest is not None and src_digest == dst_digest:
+            return None
+
     #Going through the content and comparing their hash, deleting and copying if hash is different
-    for name in os.listdir(src_path):
+    for name in filtered_listdir(src_path, rel_path, path_filter):
         current_src_filepath: str = os.path.join(src_path, name)
         current_dst_filepath: str = os.path.join(dst_path, name)
         #Recursion if the current path points to folder
         if os.path.isdir(current_src_filepath):
-            hash_check(current_src_filepath, current_dst_filepath, logger)
+            hash_check(current_src_filepath, current_dst_filepath, logger, path_filter, rel_join(rel_path, name),
+                       compare_mode, digest_cache, durability, in_place)
             continue
-        if hashing(current_src_filepath) == hashing(current_dst_filepath):
+        #only files whose stat did not change are skipped by their cached digests, the rest are compared
+        if digest_cache is not None:
+            src_file_digest = cached_file_digest(current_src_filepath, digest_cache)
+            if src_file_digest is not None and src_file_digest == cached_file_digest(current_dst_filepath, digest_cache):
+                continue
+        if compare_mode == 'bytes':
+            if compare_and_copy(current_src_filepath, current_dst_filepath, digest_cache=digest_cache,
+                                durability=durability, in_place=in_place):
+                logger.info(f'Rewrote {current_dst_filepath} in replica, due to different content, from {current_src_filepath}')
             continue
+        if digest_cache is not None:
+            same = file_digest(current_src_filepath, digest_cache) == file_digest(current_dst_filepath, digest_cache)
         else:
-            #if files are not the same, remove it from replica and copy from src
-            os.remove(current_dst_filepath)
-            shutil.copy(current_src_filepath, dst_path)
-            logger.info(f'Removed {current_dst_filepath} form replica, due to different content, copied {current_src_filepath} to replica')
+            same = hashing(current_src_filepath) == hashing(current_dst_filepath)
+        if not same:
+            #if files are not the same, replace the replica file with a copy of src
+            replace_file(current_src_filepath, current_dst_filepath, durability)
+            logger.info(f'Replaced {current_dst_filepath} in replica with {current_src_filepath}, due to different content')
 
+    durability_flush_dir(durability, dst_path)
     return None
 
 
 
 
-def folder_sync(src_path:str,replica_path:str,sync_count:int, interval:float, logger: logging.Logger) -> bool:
+def folder_sync(src_path:str,replica_path:str,sync_count:int, interval:float, logger: logging.Logger,
+                filter_patterns:list = None, compare_mode:str = 'bytes', use_digests:bool = True,
+                durability_policy:str = 'syncfs', in_place:bool = False) -> bool:
     """
     function combines copy diff and hash check.
 
@@ -215,22 +1103,39 @@ def folder_sync(src_path:str,replica_path:str,sync_count:int, interval:float, lo
     :param  logger: logging.Logger - logger
     :param sync_count:int - a number of times that synchronization will run
     :param interval:float - a time interval between the synchronizations
+    :param filter_patterns:list - gitignore-style include/exclude rules, see compile_filters
+    :param compare_mode:str - 'bytes' or 'hash', how hash_check compares files
+    :param use_digests:bool - keep Merkle folder digests between synchronizations to skip unchanged subtrees
+    :param durability_policy:str - one of DURABILITY_POLICIES, how replica writes are flushed to the disk
+    :param in_place:bool - rewrite changed files in place instead of replacing them, see compare_and_copy
     :return: None, the function doesn't return anything, but makes dst an exact copy of src
     """
+    # Rules are compiled once and reused by every synchronization
+    path_filter = compile_filters(filter_patterns or [], logger)
+    digest_cache = new_digest_cache() if use_digests else None
+
+    if durability_policy not in DURABILITY_POLICIES:
+        logger.error(f"Not valid durability policy {durability_policy}, should be one of {', '.join(DURABILITY_POLICIES)}")
+        return False
+    durability = new_durability(durability_policy)
 
     # Fail-fast permission check
-    if not permissions_check(src_path, must_write=False, logger=logger):
+    if not permissions_check(src_path, must_write=False, logger=logger, path_filter=path_filter):
         return False
 
-    if not permissions_check(replica_path, must_write=True, logger=logger):
+    if not permissions_check(replica_path, must_write=True, logger=logger, path_filter=path_filter):
         return False
 
 
     if folder_check(src_path, replica_path, logger):
         logger.info("Synchronization started")
         for i in range(sync_count):
-            copy_difference(src_path, replica_path, logger)
-            hash_check(src_path, replica_path, logger)
+            copy_difference(src_path, replica_path, logger, path_filter, durability=durability)
+            if digest_cache is not None:
+                digest_cache['pass'].clear()
+            hash_check(src_path, replica_path, logger, path_filter, compare_mode=compare_mode, digest_cache=digest_cache,
+                       durability=durability, in_place=in_place)
+            durability_finish_pass(durability, replica_path, logger)
             if i < (sync_count - 1):
                 time.sleep(interval)
         logger.info("Synchronization finihed")
@@ -281,6 +1186,7 @@ def main():
     - checks if a right amount of arguments is passed to the program
     - checking if there is '/' in the end of paths, adding if not
     - checks the values of interval and synchronization_count
+    - reads include/exclude rules from FILTER_FILE_NAME in the src root, if it exists
     - synchronizes folders if checks were passed
 
     :return: synchronizes folders
@@ -297,7 +1203,9 @@ def main():
             interval = float(sys.argv[3])
             sync_count = int(sys.argv[4])
 
-            folder_sync(src_path,replica_path,sync_count,interval,logger)
+            filter_patterns = load_filter_file(src_path)
+
+            folder_sync(src_path,replica_path,sync_count,interval,logger,filter_patterns)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,507 @@
+import os
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+import warnings
+from unittest import mock
+
+import main
+
+
+def make_file(path:str, content:bytes = b'') -> None:
+    """
+    Creates a file with the given content, creating the missing folders
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def read_file(path:str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def quiet_logger() -> logging.Logger:
+    """
+    Logger that does not write anything, so the tests do not spam the console
+    """
+    logger = logging.getLogger('sync-test')
+    logger.propagate = False
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    return logger
+
+
+class CompileFiltersTest(unittest.TestCase):
+
+    def test_no_rules(self):
+        self.assertIsNone(main.compile_filters([]))
+        self.assertIsNone(main.compile_filters(['', '   \n', '# comment\n']))
+
+    def test_name_matches_at_any_depth(self):
+        is_excluded = main.compile_filters(['*.pyc'])
+        self.assertTrue(is_excluded('a.pyc', False))
+        self.assertTrue(is_excluded('x/y/a.pyc', False))
+        self.assertFalse(is_excluded('a.py', False))
+        self.assertFalse(is_excluded('a.pyc/b', False))
+
+    def test_anchored_rules(self):
+        is_excluded = main.compile_filters(['/build', 'docs/tmp'])
+        self.assertTrue(is_excluded('build', True))
+        self.assertFalse(is_excluded('src/build', True))
+        self.assertTrue(is_excluded('docs/tmp', False))
+        self.assertFalse(is_excluded('x/docs/tmp', False))
+
+    def test_folder_only_rules(self):
+        is_excluded = main.compile_filters(['cache/'])
+        self.assertTrue(is_excluded('cache', True))
+        self.assertTrue(is_excluded('a/cache', True))
+        self.assertFalse(is_excluded('cache', False))
+
+    def test_last_matching_rule_wins(self):
+        is_excluded = main.compile_filters(['*.log', '!keep.log', 'logs/keep.log'])
+        self.assertTrue(is_excluded('a.log', False))
+        self.assertFalse(is_excluded('keep.log', False))
+        self.assertFalse(is_excluded('x/keep.log', False))
+        self.assertTrue(is_excluded('logs/keep.log', False))
+
+    def test_re_include_of_folder_only_rule(self):
+        is_excluded = main.compile_filters(['tmp*', '!tmp*/'])
+        self.assertTrue(is_excluded('tmp1', False))
+        self.assertFalse(is_excluded('tmp1', True))
+
+    def test_double_star(self):
+        is_excluded = main.compile_filters(['**/node_modules', 'a/**/b', 'out/**'])
+        self.assertTrue(is_excluded('node_modules', True))
+        self.assertTrue(is_excluded('x/y/node_modules', True))
+        self.assertTrue(is_excluded('a/b', False))
+        self.assertTrue(is_excluded('a/x/y/b', False))
+        self.assertFalse(is_excluded('c/a/b', False))
+        self.assertTrue(is_excluded('out/x/y', False))
+        self.assertFalse(is_excluded('out', True))
+
+    def test_double_star_inside_segment_works_like_star(self):
+        is_excluded = main.compile_filters(['foo**bar'])
+        self.assertTrue(is_excluded('foobar', False))
+        self.assertTrue(is_excluded('fooxbar', False))
+        self.assertFalse(is_excluded('foo/bar', False))
+        self.assertFalse(is_excluded('foox/ybar', False))
+
+    def test_question_mark_and_character_classes(self):
+        is_excluded = main.compile_filters(['file?.txt', 'data[0-9]', 'tmp[!x]'])
+        self.assertTrue(is_excluded('file1.txt', False))
+        self.assertFalse(is_excluded('file/.txt', False))
+        self.assertTrue(is_excluded('data7', False))
+        self.assertFalse(is_excluded('datax', False))
+        self.assertTrue(is_excluded('tmpa', False))
+        self.assertFalse(is_excluded('tmpx', False))
+
+    def test_character_classes_like_fnmatch(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            is_excluded = main.compile_filters(['[]a]x', 'y[z-a]', 'b[!]', 'x[/]y', 'a[[]b', 'n[!a]m'])
+        self.assertTrue(is_excluded(']x', False))
+        self.assertTrue(is_excluded('ax', False))
+        self.assertFalse(is_excluded('yz', False))
+        self.assertFalse(is_excluded('ya', False))
+        self.assertTrue(is_excluded('b[!]', False))
+        self.assertFalse(is_excluded('x/y', False))
+        self.assertTrue(is_excluded('a[b', False))
+        self.assertTrue(is_excluded('nbm', False))
+        self.assertFalse(is_excluded('n/m', False))
+
+    def test_invalid_rule_is_logged_and_skipped(self):
+        logger = quiet_logger()
+        with mock.patch.object(main, '_filter_pattern_to_regex', side_effect=['(', 'keep']), \
+                mock.patch.object(logger, 'error') as error:
+            is_excluded = main.compile_filters(['broken', 'keep'], logger)
+        self.assertEqual(error.call_count, 1)
+        self.assertTrue(is_excluded('keep', False))
+
+    def test_trailing_newline_in_name_does_not_match(self):
+        is_excluded = main.compile_filters(['*.txt'])
+        self.assertFalse(is_excluded('a.txt\n', False))
+
+    def test_escapes(self):
+        is_excluded = main.compile_filters(['\\#notes', '\\!important', 'star\\*', 'a.b'])
+        self.assertTrue(is_excluded('#notes', False))
+        self.assertTrue(is_excluded('!important', False))
+        self.assertTrue(is_excluded('star*', False))
+        self.assertFalse(is_excluded('starx', False))
+        self.assertTrue(is_excluded('a.b', False))
+        self.assertFalse(is_excluded('axb', False))
+
+
+class FolderSyncFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.replica = os.path.join(self.tmp.name, 'replica')
+        os.mkdir(self.src)
+        os.mkdir(self.replica)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_excluded_paths_are_skipped_and_left_alone(self):
+        make_file(os.path.join(self.src, main.FILTER_FILE_NAME), b'node_modules/\n*.tmp\n!keep.tmp\n')
+        make_file(os.path.join(self.src, 'a', 'file.txt'), b'content')
+        make_file(os.path.join(self.src, 'a', 'node_modules', 'lib.js'), b'lib')
+        make_file(os.path.join(self.src, 'a', 'skip.tmp'), b'skip')
+        make_file(os.path.join(self.src, 'a', 'keep.tmp'), b'keep')
+        make_file(os.path.join(self.replica, 'node_modules', 'old.js'), b'old')
+        make_file(os.path.join(self.replica, 'local.tmp'), b'local')
+        make_file(os.path.join(self.replica, 'stale.txt'), b'stale')
+
+        filter_patterns = main.load_filter_file(self.src)
+        self.assertTrue(main.folder_sync(self.src, self.replica, 2, 0, quiet_logger(), filter_patterns,
+                                         durability_policy='none'))
+
+        self.assertEqual(read_file(os.path.join(self.replica, 'a', 'file.txt')), b'content')
+        self.assertEqual(read_file(os.path.join(self.replica, 'a', 'keep.tmp')), b'keep')
+        self.assertFalse(os.path.exists(os.path.join(self.replica, 'a', 'node_modules')))
+        self.assertFalse(os.path.exists(os.path.join(self.replica, 'a', 'skip.tmp')))
+        self.assertFalse(os.path.exists(os.path.join(self.replica, 'stale.txt')))
+        # excluded paths that exist only in the replica are not deleted
+        self.assertEqual(read_file(os.path.join(self.replica, 'node_modules', 'old.js')), b'old')
+        self.assertEqual(read_file(os.path.join(self.replica, 'local.tmp')), b'local')
+
+
+class CompareAndCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src_file = os.path.join(self.tmp.name, 'src_file')
+        self.dst_file = os.path.join(self.tmp.name, 'dst_file')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_files_are_not_rewritten(self):
+        make_file(self.src_file, b'a' * 5000)
+        make_file(self.dst_file, b'a' * 5000)
+        self.assertFalse(main.compare_and_copy(self.src_file, self.dst_file, 1024))
+
+    def test_empty_and_small_files(self):
+        make_file(self.src_file)
+        make_file(self.dst_file)
+        self.assertFalse(main.compare_and_copy(self.src_file, self.dst_file))
+        make_file(self.src_file, b'x' * 4096)
+        make_file(self.dst_file, b'x' * 4095 + b'y')
+        self.assertTrue(main.compare_and_copy(self.src_file, self.dst_file))
+        self.assertEqual(read_file(self.dst_file), b'x' * 4096)
+
+    def test_changed_replica_is_replaced(self):
+        make_file(self.src_file, b'a' * 5000 + b'b' * 5000)
+        make_file(self.dst_file, b'a' * 5000 + b'c' * 5000)
+        os.chmod(self.src_file, 0o640)
+        old_inode = os.stat(self.dst_file).st_ino
+        durability = main.new_durability('file')
+        self.assertTrue(main.compare_and_copy(self.src_file, self.dst_file, 1024, durability=durability))
+        self.assertEqual(read_file(self.dst_file), read_file(self.src_file))
+        self.assertNotEqual(os.stat(self.dst_file).st_ino, old_inode)
+        self.assertEqual(os.stat(self.dst_file).st_mode & 0o777, 0o640)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['dst_file', 'src_file'])
+        # the temporary file before the rename and the folder after it
+        self.assertEqual(durability['fsync_count'], 2)
+
+    def test_failed_replace_keeps_replica(self):
+        make_file(self.src_file, b'bbbbbbbbbb')
+        make_file(self.dst_file, b'aaaaaaaaaa')
+        with mock.patch('main.os.replace', side_effect=OSError(28, 'No space left on device')):
+            with self.assertRaises(OSError):
+                main.compare_and_copy(self.src_file, self.dst_file)
+        self.assertEqual(read_file(self.dst_file), b'aaaaaaaaaa')
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['dst_file', 'src_file'])
+
+    def test_rewrites_in_place_from_the_first_mismatching_block(self):
+        make_file(self.src_file, b'a' * 5000 + b'b' * 5000)
+        make_file(self.dst_file, b'a' * 5000 + b'c' * 5000)
+        old_inode = os.stat(self.dst_file).st_ino
+        self.assertTrue(main.compare_and_copy(self.src_file, self.dst_file, 1024, in_place=True))
+        self.assertEqual(read_file(self.dst_file), read_file(self.src_file))
+        self.assertEqual(os.stat(self.dst_file).st_ino, old_inode)
+
+    def test_read_only_replica_is_replaced(self):
+        make_file(self.src_file, b'bbbbbbbbbb')
+        make_file(self.dst_file, b'aaaaaaaaaa')
+        os.chmod(self.src_file, 0o444)
+        os.chmod(self.dst_file, 0o444)
+        # root can write to read-only files, so the access check is forced to fail
+        with mock.patch('main.os.access', return_value=False):
+            self.assertTrue(main.compare_and_copy(self.src_file, self.dst_file, in_place=True))
+        self.assertEqual(read_file(self.dst_file), b'bbbbbbbbbb')
+        self.assertEqual(os.stat(self.dst_file).st_mode & 0o777, 0o444)
+
+    def test_hard_links_of_replica_are_not_changed(self):
+        link_path = os.path.join(self.tmp.name, 'snapshot')
+        make_file(self.src_file, b'bbbbbbbbbb')
+        make_file(self.dst_file, b'aaaaaaaaaa')
+        os.link(self.dst_file, link_path)
+        self.assertTrue(main.compare_and_copy(self.src_file, self.dst_file, in_place=True))
+        self.assertEqual(read_file(self.dst_file), b'bbbbbbbbbb')
+        self.assertEqual(read_file(link_path), b'aaaaaaaaaa')
+
+
+class ParallelFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src_file = os.path.join(self.tmp.name, 'src_file')
+        self.dst_file = os.path.join(self.tmp.name, 'dst_file')
+        # small thresholds so that a few hundred KB file is split into several ranges
+        for name, value in (('PARALLEL_FILE_THRESHOLD', 100_000), ('PARALLEL_RANGE_SIZE', 30_000),
+                            ('COMPARE_CHUNK_SIZE', 8_000)):
+            constant_patch = mock.patch.object(main, name, value)
+            constant_patch.start()
+            self.addCleanup(constant_patch.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_copy_file_is_identical_and_keeps_mode(self):
+        content = os.urandom(250_001)
+        make_file(self.src_file, content)
+        os.chmod(self.src_file, 0o640)
+        with mock.patch('main.parallel_copy_range', side_effect=main.parallel_copy_range) as parallel_copy_range:
+            main.copy_file(self.src_file, self.dst_file)
+        self.assertEqual(parallel_copy_range.call_count, 1)
+        self.assertEqual(read_file(self.dst_file), content)
+        self.assertEqual(os.stat(self.dst_file).st_mode & 0o777, 0o640)
+
+    def test_copy_file_without_fallocate_support(self):
+        content = os.urandom(150_000)
+        make_file(self.src_file, content)
+        make_file(self.dst_file, b'x' * 400_000)
+        with mock.patch('main.os.posix_fallocate', side_effect=OSError(95, 'Operation not supported'), create=True):
+            main.copy_file(self.src_file, self.dst_file)
+        self.assertEqual(read_file(self.dst_file), content)
+
+    def test_large_rewrite_in_place_is_identical(self):
+        content = os.urandom(250_000)
+        changed = bytearray(content)
+        changed[10_000] ^= 1
+        make_file(self.src_file, content)
+        make_file(self.dst_file, bytes(changed))
+        with mock.patch('main.parallel_copy_range', side_effect=main.parallel_copy_range) as parallel_copy_range:
+            self.assertTrue(main.compare_and_copy(self.src_file, self.dst_file, 8_000, in_place=True))
+        self.assertEqual(parallel_copy_range.call_count, 1)
+        # only the part after the first mismatching block is copied
+        self.assertEqual(parallel_copy_range.call_args.args[2], 16_000)
+        self.assertEqual(read_file(self.dst_file), content)
+
+    def test_parallel_hashing(self):
+        content = os.urandom(250_000)
+        changed = bytearray(content)
+        changed[-1] ^= 1
+        make_file(self.src_file, content)
+        make_file(self.dst_file, content)
+        self.assertEqual(main.parallel_hashing(self.src_file), main.parallel_hashing(self.dst_file))
+        self.assertEqual(main.hashing(self.src_file), main.parallel_hashing(self.src_file))
+        make_file(self.dst_file, bytes(changed))
+        self.assertNotEqual(main.parallel_hashing(self.src_file), main.parallel_hashing(self.dst_file))
+
+
+class DigestCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.replica = os.path.join(self.tmp.name, 'replica')
+        os.mkdir(self.src)
+        os.mkdir(self.replica)
+        # new files would not be cached for DIGEST_RACY_NS, so the tests trust them right away
+        racy_patch = mock.patch.object(main, 'DIGEST_RACY_NS', -1)
+        racy_patch.start()
+        self.addCleanup(racy_patch.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def sync(self, digest_cache:dict) -> None:
+        main.copy_difference(self.src, self.replica, quiet_logger())
+        digest_cache['pass'].clear()
+        main.hash_check(self.src, self.replica, quiet_logger(), digest_cache=digest_cache)
+
+    def test_change_with_restored_mtime_is_noticed(self):
+        make_file(os.path.join(self.src, 'a', 'file'), b'aaaa')
+        digest_cache = main.new_digest_cache()
+        self.sync(digest_cache)
+        self.sync(digest_cache)
+
+        src_file = os.path.join(self.src, 'a', 'file')
+        file_stat = os.stat(src_file)
+        make_file(src_file, b'bbbb')
+        os.utime(src_file, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+        self.sync(digest_cache)
+        self.assertEqual(read_file(os.path.join(self.replica, 'a', 'file')), b'bbbb')
+
+    def test_changed_file_is_compared_without_hashing(self):
+        make_file(os.path.join(self.src, 'big'), b'a' * 300_000)
+        digest_cache = main.new_digest_cache()
+        self.sync(digest_cache)
+        make_file(os.path.join(self.src, 'big'), b'b' + b'a' * 299_999)
+
+        with mock.patch('main.hashing', side_effect=main.hashing) as hashing, \
+                mock.patch('main.compare_and_copy', side_effect=main.compare_and_copy) as compare_and_copy:
+            self.sync(digest_cache)
+        self.assertEqual(hashing.call_count, 0)
+        self.assertEqual(compare_and_copy.call_count, 1)
+        self.assertEqual(read_file(os.path.join(self.replica, 'big')), read_file(os.path.join(self.src, 'big')))
+
+    def test_unchanged_tree_is_skipped(self):
+        make_file(os.path.join(self.src, 'a', 'b', 'file'), b'aaaa')
+        make_file(os.path.join(self.src, 'top'), b'top')
+        digest_cache = main.new_digest_cache()
+        self.sync(digest_cache)
+        # the second synchronization compares the files once and stores their digests
+        self.sync(digest_cache)
+
+        with mock.patch('main.hashing', side_effect=main.hashing) as hashing, \
+                mock.patch('main.compare_and_copy', side_effect=main.compare_and_copy) as compare_and_copy:
+            self.sync(digest_cache)
+        self.assertEqual(hashing.call_count, 0)
+        self.assertEqual(compare_and_copy.call_count, 0)
+
+    def test_digest_from_comparison_is_the_same_as_hashing(self):
+        with mock.patch.object(main, 'PARALLEL_FILE_THRESHOLD', 100_000), \
+                mock.patch.object(main, 'PARALLEL_RANGE_SIZE', 30_000):
+            for size in (10, 100_000, 150_000, 150_001):
+                content = os.urandom(size)
+                src_file = os.path.join(self.src, f'file{size}')
+                dst_file = os.path.join(self.replica, f'file{size}')
+                make_file(src_file, content)
+                make_file(dst_file, content)
+                digest_cache = main.new_digest_cache()
+                self.assertFalse(main.compare_and_copy(src_file, dst_file, 7_000, digest_cache))
+                self.assertEqual(digest_cache['pass'][src_file], main.hashing(src_file))
+                self.assertEqual(digest_cache['pass'][dst_file], main.hashing(dst_file))
+
+    def test_deleted_paths_are_dropped_from_the_cache(self):
+        make_file(os.path.join(self.src, 'a', 'b', 'file'), b'aaaa')
+        make_file(os.path.join(self.src, 'other'), b'other')
+        digest_cache = main.new_digest_cache()
+        self.sync(digest_cache)
+        self.assertIn(os.path.join(self.src, 'a', 'b', 'file'), digest_cache['nodes'])
+
+        shutil.rmtree(os.path.join(self.src, 'a'))
+        self.sync(digest_cache)
+        deleted = [path for path in digest_cache['nodes'] if os.sep + 'a' in path[len(self.tmp.name):]]
+        self.assertEqual(deleted, [])
+        self.assertFalse(os.path.exists(os.path.join(self.replica, 'a')))
+
+
+class CopyDifferenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.replica = os.path.join(self.tmp.name, 'replica')
+        os.mkdir(self.src)
+        os.mkdir(self.replica)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_small_files_keep_content_and_permissions(self):
+        make_file(os.path.join(self.src, 'a', 'small'), b'small')
+        make_file(os.path.join(self.src, 'a', 'empty'))
+        make_file(os.path.join(self.src, 'exe'), b'#!')
+        os.chmod(os.path.join(self.src, 'exe'), 0o755)
+        main.copy_difference(self.src, self.replica, quiet_logger())
+        self.assertEqual(read_file(os.path.join(self.replica, 'a', 'small')), b'small')
+        self.assertEqual(read_file(os.path.join(self.replica, 'a', 'empty')), b'')
+        self.assertEqual(os.stat(os.path.join(self.replica, 'exe')).st_mode & 0o777, 0o755)
+
+    def test_permissions_do_not_depend_on_umask(self):
+        make_file(os.path.join(self.src, 'small'), b'small')
+        os.chmod(os.path.join(self.src, 'small'), 0o644)
+        old_umask = os.umask(0o077)
+        try:
+            main.copy_difference(self.src, self.replica, quiet_logger())
+        finally:
+            os.umask(old_umask)
+        self.assertEqual(os.stat(os.path.join(self.replica, 'small')).st_mode & 0o777, 0o644)
+
+    @unittest.skipUnless(hasattr(os, 'mkfifo'), 'named pipes are not supported')
+    def test_named_pipe_is_not_opened(self):
+        os.mkfifo(os.path.join(self.src, 'pipe'))
+        errors = []
+
+        def copy():
+            try:
+                main.copy_difference(self.src, self.replica, quiet_logger())
+            except shutil.SpecialFileError as error:
+                errors.append(error)
+
+        copy_thread = threading.Thread(target=copy, daemon=True)
+        copy_thread.start()
+        copy_thread.join(5)
+        self.assertFalse(copy_thread.is_alive(), 'copy_difference is blocked on the named pipe')
+        self.assertEqual(len(errors), 1)
+
+
+class HashCompareModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.replica = os.path.join(self.tmp.name, 'replica')
+        make_file(os.path.join(self.src, 'a', 'file'), b'new')
+        make_file(os.path.join(self.src, 'same'), b'same')
+        make_file(os.path.join(self.replica, 'a', 'file'), b'old')
+        make_file(os.path.join(self.replica, 'same'), b'same')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check_sync(self, use_digests:bool) -> None:
+        self.assertTrue(main.folder_sync(self.src, self.replica, 2, 0, quiet_logger(), compare_mode='hash',
+                                         use_digests=use_digests, durability_policy='none'))
+        self.assertEqual(read_file(os.path.join(self.replica, 'a', 'file')), b'new')
+        self.assertEqual(read_file(os.path.join(self.replica, 'same')), b'same')
+
+    def test_with_digests(self):
+        self.check_sync(True)
+
+    def test_without_digests(self):
+        self.check_sync(False)
+
+
+class DurabilityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.replica = os.path.join(self.tmp.name, 'replica')
+        os.mkdir(self.src)
+        os.mkdir(self.replica)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_syncfs_only_after_writes(self):
+        make_file(os.path.join(self.src, 'a', 'file'), b'aaaa')
+        logger = quiet_logger()
+        with mock.patch('main._syncfs') as syncfs, self.assertLogs(logger, logging.INFO) as logs:
+            self.assertTrue(main.folder_sync(self.src, self.replica, 3, 0, logger, durability_policy='syncfs'))
+        self.assertEqual(syncfs.call_count, 1)
+        # passes that wrote nothing do not log the cost of the policy either
+        self.assertEqual(sum('Durability policy' in line for line in logs.output), 1)
+
+    def test_dir_policy_flushes_written_files_and_folders(self):
+        make_file(os.path.join(self.src, 'a', 'file'), b'aaaa')
+        durability = main.new_durability('dir')
+        with mock.patch('main._fsync_path') as fsync_path:
+            main.copy_difference(self.src, self.replica, quiet_logger(), durability=durability)
+        flushed = {os.path.normpath(call.args[1]) for call in fsync_path.call_args_list}
+        self.assertEqual(flushed, {os.path.join(self.replica, 'a', 'file'), os.path.join(self.replica, 'a'),
+                                   os.path.normpath(self.replica)})
+
+
+if __name__ == '__main__':
+    unittest.main()